@@ -1,23 +1,70 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import os
+import shutil
 import subprocess
 import requests
+from requests.adapters import HTTPAdapter, Retry
 from datetime import datetime
 from PIL import Image
 import re
+import functools
 import concurrent.futures
 import json
 import logging
 import hashlib
 
+# 装了 orjson 就用（C 实现直接解析 bytes），否则退回标准库
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 预编译所有正则，避免每处理一个 Markdown 文件都重新查找 re 缓存
+# preprocess_markdown 的三个转换（图片补反斜杠 / 链接缩短 / <img> 转义）
+# 合并成一个交替模式，对内容只扫描一遍
+_PREPROC_RE = re.compile(
+    r'(?P<img>!\[[^\]]*\]\([^)]+\))'
+    r'|(?<!!)\[(?P<ltxt>.*?)\]\((?P<url>.*?)\)'
+    r'|(?<!`)<img(?P<tagend>\s*>)(?!`)',
+    re.IGNORECASE)
+_CODE_BLOCK_RE = re.compile(r'```.*?```', re.DOTALL)
+_MD_IMG_URL_RE = re.compile(r'!\[.*?\]\((http[^\)]+)\)')
+_HTML_IMG_URL_RE = re.compile(r'<img[^>]+src="([^"]+)"')
+# 代码块占位符用 NUL 字节包裹，保证不会和正文内容撞车
+_CODE_BLOCK_PLACEHOLDER_RE = re.compile('\x00CB(\\d+)\x00')
+# 行首 1-6 个 # 且后跟空白才算标题，避免误伤正文中的 #tag
+_HEADING_RE = re.compile(r'(?m)^(#{1,6})(?=\s|$)')
+# 文件开头的 YAML front matter（懒惰匹配到第一个闭合 ---）
+_FRONT_MATTER_RE = re.compile(r'\A\s*---\s*\n.*?\n---\s*(?:\n|\Z)', re.DOTALL)
+
+# 已处理图片按 URL 哈希落盘缓存，二次运行或跨书重复的图片零网络零 PIL
+CACHE_DIR = os.path.expanduser('~/.cache/epubpack/images')
+
+# 所有下载共用一个 Session，复用 keep-alive 连接避免每张图片重新握手
+_SESSION = requests.Session()
+_SESSION.headers['User-Agent'] = 'epubpack/1.0'
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+    ),
+)
+_SESSION.mount('http://', _adapter)
+_SESSION.mount('https://', _adapter)
+
 def load_config(config_path="./config/config.json"):
     config={}
 
     try:
-        with open(config_path,'r',encoding='utf-8') as f:
-            config = json.load(f) or {}
+        with open(config_path,'rb') as f:
+            config = _json_loads(f.read()) or {}
             logging.info(f"Load config file success: {config_path}")
     except FileNotFoundError:
         logging.error(f"配置文件 {config_path} 未找到")
@@ -28,206 +75,215 @@ def load_config(config_path="./config/config.json"):
 
     return config
 
+def _preprocess_repl(m, url_limit=60):
+    """_PREPROC_RE 的分发回调，按命中的分支做对应转换"""
+    # 在图片内容后面添加 \ 符号以避免 pandoc 生成 EPUB 时在下方附带图片标题
+    if m.group('img'):
+        return m.group('img') + '\\'
+    # 过长的链接 URL 缩短，并用反引号包裹以免 pandoc 断行
+    if m.group('url') is not None:
+        link_text, url = m.group('ltxt'), m.group('url')
+        if len(url) > url_limit:
+            url = url[:30] + '...' + url[-7:]
+        return f'`[{link_text}]({url})`'
+    # 部分 <img> 标签会导致 EPUB 报错，添加转义字符（跳过 `<img>`）
+    return f"&lt;img{m.group('tagend')}"
+
 def preprocess_markdown(content):
-    # 部分 <img> 标签会导致 EPUB 报错
-    # 给 <img> 标签添加转义字符
-    # 避免匹配 `<img>` 标签
-    def escape_img_tags(text):
-        return re.sub(
-            r'(?<!`)(<img)(\s*>)(?!`)',
-            lambda m: f"&lt;{m.group(1)[1:]}{m.group(2)}",  # 此处仅为示例转换
-            text,
-            flags=re.IGNORECASE
-        )
+    # 三个行级转换合并进一个交替模式，一次扫描完成
+    return _PREPROC_RE.sub(_preprocess_repl, content)
 
-    # 在图片内容后面添加 \ 符号以避免 pandoc 生成 EPUB 时在下方附带图片标题
-    def add_backslash_to_md_images(text):
-        pattern = r'(!\[[^\]]*\]\([^)]+\))'
-        replacement = r'\1\\'
-        return re.sub(pattern, replacement, text)
-
-    _LINK_PATTERN = re.compile(r'(?<!!)\[(.*?)\]\((.*?)\)')
-    def convert_links_to_readable(text, url_limit=60):
-        def replacement(match):
-            link_text, url = match.groups()
-            # Shorten URL if needed
-            if len(url) > url_limit:
-                shortened_url = url[:30] + '...' + url[-7:]
-            else:
-                shortened_url = url
-            return f'`[{link_text}]({shortened_url})`'
-
-        return _LINK_PATTERN.sub(replacement, text)
-
-    content = add_backslash_to_md_images(content)
-    content = convert_links_to_readable(content)
-    content = escape_img_tags(content)
-
-    return content
-
-def download_image(url, output_dir):
-    """Download an image from URL, process it, and save to the output directory."""
+def _pil_process(data, image_path, url, max_size=(500, 500)):
+    """解码、缩放并编码图片（模块级函数，可提交到子进程绕开 GIL）"""
+    img = Image.open(io.BytesIO(data))
+
+    needs_convert = (img.mode in ('RGBA', 'LA')
+                     or (img.mode == 'P' and 'transparency' in img.info))
+
+    # Determine save format based on file extension
+    file_ext = os.path.splitext(image_path)[1].lower()
+    save_format = 'JPEG' if file_ext == '.jpg' else 'PNG'
+
+    if (img.format == 'JPEG' and save_format == 'JPEG' and not needs_convert
+            and img.width <= max_size[0] and img.height <= max_size[1]):
+        # 已是目标格式且尺寸达标的 JPEG 原样落盘，省掉一次解码+重编码
+        with open(image_path, 'wb') as f:
+            f.write(data)
+    else:
+        # JPEG 先用 draft 模式在解码阶段就按 1/2、1/4、1/8 缩小，
+        # 大图可以省掉大部分 IDCT 计算量
+        if img.format == 'JPEG':
+            img.draft('RGB', max_size)
+
+        # Convert to RGB mode if needed
+        if needs_convert:
+            img = img.convert('RGB')
+
+        # 小尺寸缩略图用 BILINEAR（2 抽头）即可，乘加量远小于 LANCZOS（8 抽头）；
+        # EPUB 阅读器渲染时还会再缩放，这个档位的画质差异不可见
+        resample = (Image.Resampling.BILINEAR if max(max_size) <= 512
+                    else Image.Resampling.LANCZOS)
+        img.thumbnail(max_size, resample)
+
+        # 优化编码参数：同等画质下文件更小，EPUB 体积随之缩小
+        if save_format == 'JPEG':
+            img.save(image_path, save_format, quality=80,
+                     optimize=True, progressive=True, subsampling=2)
+        else:
+            img.save(image_path, save_format, optimize=True, compress_level=9)
+
+    # 处理结果写入缓存，供重跑和其他书复用
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        cached = _cache_path_for(url, file_ext)
+        if not os.path.exists(cached):
+            _link_or_copy(image_path, cached)
+    except Exception as e:
+        logging.warning(f"写入图片缓存失败: {e}")
+
+    return image_path
+
+def fetch_and_process(url, output_dir, max_size=(500, 500), cpu_pool=None):
+    """下载图片并在内存中一次性完成转换、缩放和压缩，最后只写盘一次"""
     try:
         # Create output directory if it doesn't exist
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
+        # 命中缓存则直接链接进书目录，跳过下载和 PIL 处理
+        cached = _cache_lookup(url)
+        if cached:
+            image_path = _generate_image_path(
+                url, os.path.splitext(cached)[1], output_dir)
+            if not os.path.exists(image_path):
+                _link_or_copy(cached, image_path)
+            return image_path
+
         # Download image
-        response = requests.get(url)
+        response = _SESSION.get(url, timeout=(5, 30))
         response.raise_for_status()
 
         # Generate file path with appropriate extension
-        image_path = _generate_image_path(url, response, output_dir)
-
-        # Save the original image
-        with open(image_path, 'wb') as f:
-            f.write(response.content)
-
-        # Process the image
-        if not _process_image(image_path):
-            return None
+        content_type = response.headers.get('content-type', '').lower()
+        image_path = _generate_image_path(
+            url, _get_extension(url, content_type), output_dir)
 
-        return image_path
+        # 下载线程只负责 I/O，PIL 的解码/缩放/编码交给进程池并行
+        if cpu_pool is not None:
+            return cpu_pool.submit(
+                _pil_process, response.content, image_path, url, max_size).result()
+        return _pil_process(response.content, image_path, url, max_size)
 
     except Exception as e:
         print(f"图像下载失败:{url}, error:{e}")
         return None
 
+# content-type 子类型 / URL 后缀 → 保存后缀（webp 统一转成 jpg）
+_MIME_EXT = {'jpeg': '.jpg', 'jpg': '.jpg', 'png': '.png', 'gif': '.gif', 'webp': '.jpg'}
+_URL_EXT = {'.jpg': '.jpg', '.jpeg': '.jpg', '.png': '.png', '.gif': '.gif', '.webp': '.jpg'}
+
 def _get_extension(url, content_type):
     """Determine file extension based on content type and URL."""
+    subtype = content_type.rsplit('/', 1)[-1].split(';', 1)[0].strip()
     original_ext = os.path.splitext(url)[1].lower()
+    return _MIME_EXT.get(subtype) or _URL_EXT.get(original_ext, '.jpg')
 
-    # Determine extension based on content type
-    if 'jpeg' in content_type or 'jpg' in content_type or original_ext in ['.jpg', '.jpeg']:
-        return '.jpg'
-    elif 'png' in content_type or original_ext == '.png':
-        return '.png'
-    elif 'gif' in content_type or original_ext == '.gif':
-        return '.gif'
-    elif 'webp' in content_type or original_ext == '.webp':
-        return '.jpg'  # Convert webp to jpg
-
-    # Fallback to URL extension
-    if original_ext in ['.jpg', '.jpeg', '.png', '.gif']:
-        return original_ext
-
-    # Default extension
-    return '.jpg'
-
-def _generate_image_path(url, response, output_dir):
-    """Generate a unique filename for the image."""
-    content_type = response.headers.get('content-type', '').lower()
-    final_ext = _get_extension(url, content_type)
-
-    # Create unique filename
-    hash_value = hashlib.md5(url.encode()).hexdigest()[:8]
-    image_name = f"image_{datetime.now().strftime('%H%M%S')}_{hash_value}{final_ext}"
+def _generate_image_path(url, final_ext, output_dir):
+    """Generate a deterministic filename for the image."""
+    # 文件名只由 URL 哈希决定，重跑时同一张图落到同一个名字
+    image_name = f"{hashlib.md5(url.encode()).hexdigest()}{final_ext}"
 
     return os.path.join(output_dir, image_name)
 
-def _process_image(image_path):
-    """Process the image with PIL."""
-    try:
-        with Image.open(image_path) as img:
-            # Convert to RGB mode if needed
-            if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-                img = img.convert('RGB')
-
-            # Determine save format based on file extension
-            file_ext = os.path.splitext(image_path)[1].lower()
-            save_format = 'JPEG' if file_ext == '.jpg' else 'PNG'
+def _cache_path_for(url, final_ext):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, key + final_ext)
 
-            # Save processed image
-            img.save(image_path, save_format, quality=70)
-        return True
+def _cache_lookup(url):
+    """查询缓存中是否已有该 URL 处理好的图片"""
+    for ext in ('.jpg', '.png', '.gif'):
+        cached = _cache_path_for(url, ext)
+        if os.path.exists(cached):
+            return cached
+    return None
 
-    except Exception as e:
-        print(f"图片处理失败: {e}")
-        if os.path.exists(image_path):
-            os.remove(image_path)
-        return False
-
-def compress_image(image_path, output_dir=None, max_size=(500, 500)):
+def _link_or_copy(src, dest):
+    """优先硬链接，跨文件系统时退化为复制；目标已存在视为成功"""
     try:
-        with Image.open(image_path) as img:
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-
-            if output_dir:
-                if not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
-                compressed_path = os.path.join(output_dir, os.path.basename(image_path))
-            else:
-                compressed_path = image_path
-
-            img.save(compressed_path, quality=80)
-
-            return compressed_path
-
-    except Exception as e:
-        print(f"压缩图像失败: {image_path}, 错误: {e}")
-        return None
-
-def process_image_urls_in_md(md_file, output_dir):
-    """处理 Markdown 文件中的所有图像链接"""
+        os.link(src, dest)
+    except FileExistsError:
+        # 多本书并发处理同一 URL 时输家会走到这里，缓存里已有成品，不要覆盖
+        pass
+    except OSError:
+        # 先写临时文件再原子替换，并发读取方不会看到写了一半的内容
+        tmp = f"{dest}.tmp.{os.getpid()}"
+        try:
+            shutil.copy(src, tmp)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+def process_image_urls_in_text(original_content, output_dir):
+    """处理 Markdown 内容中的所有图像链接，返回处理后的内容"""
     """图像链接分为 Markdown 和 HTML 两种格式"""
-    with open(md_file, 'r', encoding='utf-8') as f:
-        original_content = f.read()
+    # 1) 提取出三重反引号的代码块：单次 sub 回调边收集边替换，
+    # 天然保证每个代码块只被替换一次，重复内容也不会出问题
+    code_blocks = []
 
-    # 1) 提取出三重反引号的代码块
-    code_block_pattern = re.compile(r'```.*?```', re.DOTALL)
-    code_blocks = code_block_pattern.findall(original_content)
+    def _stash_code_block(m):
+        code_blocks.append(m.group(0))
+        return f"\x00CB{len(code_blocks) - 1}\x00"
 
-    # 创建用来存放代码块的占位符
-    content = original_content
-    for i, block in enumerate(code_blocks):
-        placeholder = f"__CODE_BLOCK_{i}__"
-        # 使用 replace(block, placeholder, 1) 保证只替换一次，否则如果某个代码块内容重复，会出问题
-        content = content.replace(block, placeholder, 1)
+    content = _CODE_BLOCK_RE.sub(_stash_code_block, original_content)
 
     # 匹配 Markdown 语法的图像链接
-    markdown_image_urls = re.findall(r'!\[.*?\]\((http[^\)]+)\)', content)
+    markdown_image_urls = _MD_IMG_URL_RE.findall(content)
     # 匹配 HTML 语法的图像链接
-    html_image_urls = re.findall(r'<img[^>]+src="([^"]+)"', content)
-    image_urls = []
-    for url in markdown_image_urls + html_image_urls:
-            if url.startswith("http"):
-                image_urls.append(url)
+    html_image_urls = _HTML_IMG_URL_RE.findall(content)
+    # 去重后再下载，同一 URL 出现多次只取一次（替换时会全局生效）
+    image_urls = list(dict.fromkeys(
+        url for url in markdown_image_urls + html_image_urls
+        if url.startswith("http")))
     compressed_images = []
     replacements = []
 
-    def process_single_url(url):
+    def process_single_url(url, cpu_pool):
         try:
-            image_path = download_image(url,output_dir)
+            image_path = fetch_and_process(url, output_dir, cpu_pool=cpu_pool)
             if image_path:
-                compressed_image_path = compress_image(image_path,output_dir)
-                if compressed_image_path:
-                    return (url, os.path.basename(compressed_image_path))
+                return (url, os.path.basename(image_path))
         except Exception as e:
             print(f"Error processing {url[:30]}...: {str(e)}")
         return (None, None)
 
-    # 创建线程池执行并行下载
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_single_url, url) for url in image_urls]
-
-        for future in concurrent.futures.as_completed(futures):
-            original_url, new_filename = future.result()
-            if new_filename:
-                replacements.append((original_url, new_filename))
-                compressed_images.append(os.path.join(output_dir, new_filename))
-
-    for original_url, new_filename in replacements:
-        content = content.replace(original_url, f"images/{new_filename}")
-
-    # 还原代码块
-    for i, block in enumerate(code_blocks):
-        placeholder = f"__CODE_BLOCK_{i}__"
-        content = content.replace(placeholder, block,1)
-
-    with open(md_file, 'w', encoding='utf-8') as f:
-            f.write(content)
-
-    return compressed_images
+    # 线程池负责网络 I/O，进程池负责 PIL 的 CPU 部分，互不拖累
+    # 外层已经按书并行，这里控制住书内并发度，避免 N_books x N_workers 爆炸
+    max_workers = 4
+    if image_urls:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as cpu_pool, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(process_single_url, url, cpu_pool)
+                       for url in image_urls]
+
+            for future in concurrent.futures.as_completed(futures):
+                original_url, new_filename = future.result()
+                if new_filename:
+                    replacements.append((original_url, new_filename))
+                    compressed_images.append(os.path.join(output_dir, new_filename))
+
+    # 一次遍历完成所有 URL 替换，避免每张图片都重新扫描全文
+    if replacements:
+        mapping = {url: f"images/{name}" for url, name in replacements}
+        url_pattern = re.compile('|'.join(map(re.escape, mapping)))
+        content = url_pattern.sub(lambda m: mapping[m.group(0)], content)
+
+    # 一次遍历还原所有代码块
+    content = _CODE_BLOCK_PLACEHOLDER_RE.sub(
+        lambda m: code_blocks[int(m.group(1))], content)
+
+    return content, compressed_images
 
 def generate_metadata(root_dir):
     """生成电子书元数据"""
@@ -237,85 +293,111 @@ def generate_metadata(root_dir):
         "date": datetime.now().strftime("%Y-%m-%d"),
     }
 
+_NAT_SPLIT_RE = re.compile(r'(\d+)')
+
+@functools.lru_cache(maxsize=8192)
 def natural_sort_key(s):
-    return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
+    # 返回元组：可哈希（能进 lru_cache），比较也比列表快
+    return tuple(int(text) if text.isdigit() else text.lower()
+                 for text in _NAT_SPLIT_RE.split(s))
+
+def _collect_entries(current_dir, entries, level=0):
+    """递归收集目录结构，生成有序的 (标题文本 / 待插入文件) 列表"""
+    # scandir 的 DirEntry 自带 is_dir 缓存，省掉每个条目一次 stat
+    with os.scandir(current_dir) as it:
+        items = [entry for entry in it if not entry.name.startswith(('_', '.'))]
+    items.sort(key=lambda entry: natural_sort_key(entry.name))
+
+    for entry in items:
+        if entry.is_dir(follow_symlinks=False):
+            header = "#" * (level + 1)
+            entries.append(("text", f"{header} {entry.name}\n\n", None))
+            _collect_entries(entry.path, entries, level + 1)
+        elif entry.name.lower().endswith((".html", ".md")):
+            # 为文件内容创建一个新的标题层级
+            file_header = "#" * (level + 1)
+            entries.append(("text", f"{file_header} {os.path.splitext(entry.name)[0]}\n\n", None))
+            entries.append(("file", entry.path, level + 1))
+            entries.append(("text", "\n\n", None))
+
+def _convert_html_to_md(file_path):
+    """调用 pandoc 把 HTML 转成 Markdown"""
+    return subprocess.check_output(
+        ["pandoc", "-f", "html", "-t", "markdown", file_path],
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
 
 def process_directory(current_dir, file_handler, root_dir, level=0):
     """递归处理目录结构，同时跳过临时目录和隐藏文件，并按名称顺序排序"""
-    for item in sorted(os.listdir(current_dir), key=natural_sort_key):
-        if item.startswith(('_', '.')):
-            continue
-
-        path = os.path.join(current_dir, item)
-        if os.path.isdir(path):
-            header = "#" * (level + 1)
-            file_handler.write(f"{header} {item}\n\n")
-            process_directory(path, file_handler, root_dir, level + 1)
+    entries = []
+    _collect_entries(current_dir, entries, level)
+
+    # 先并发把所有 HTML 转成 Markdown（subprocess 等待期间会释放 GIL），
+    # pandoc 启动开销不再串行累加，再按目录顺序拼装
+    html_paths = [path for kind, path, _ in entries
+                  if kind == "file" and path.lower().endswith(".html")]
+    converted = {}
+    if html_paths:
+        # 外层已经按书并行，这里控制住书内 pandoc 进程数，避免 N_books x N_workers 爆炸
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {executor.submit(_convert_html_to_md, path): path
+                       for path in html_paths}
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                try:
+                    converted[path] = future.result()
+                except Exception:
+                    # 转换失败的文件留给 include_content 统一报错
+                    pass
+
+    for kind, value, file_level in entries:
+        if kind == "text":
+            file_handler.write(value)
         else:
-            if item.lower().endswith((".html", ".md")):
-                # 为文件内容创建一个新的标题层级
-                file_header = "#" * (level + 1)
-                file_handler.write(f"{file_header} {os.path.splitext(item)[0]}\n\n")
-                include_content(path, file_handler, level + 1)
-                file_handler.write("\n\n")
+            include_content(value, file_handler, file_level, converted.get(value))
 
 def remove_yaml_front_matter(content):
-    """检测内容是否以 YAML front matter 开头"""
-    content = content.lstrip()
-    if content.startswith("---"):
-        lines = content.splitlines()
-        for i in range(1, len(lines)):
-            if lines[i].strip() == "---":
-                return "\n".join(lines[i+1:]).lstrip()
-    return content
-
-def include_content(file_path, file_handler, base_level):
+    """剔除内容开头的 YAML front matter"""
+    # 单次有界正则替换，不再为定位闭合 --- 把整个文件 splitlines
+    return _FRONT_MATTER_RE.sub('', content, count=1).lstrip()
+
+def include_content(file_path, file_handler, base_level, converted=None):
     """将文件内容插入主文档，处理 Markdown 文件时剔除 YAML front matter 并调整标题层级"""
     try:
         content = ""
-        if file_path.lower().endswith(".html"):
-            content = subprocess.check_output(
-                ["pandoc", "-f", "html", "-t", "markdown", file_path],
-                stderr=subprocess.PIPE,
-                universal_newlines=True
-            )
+        if converted is not None:
+            content = converted
+        elif file_path.lower().endswith(".html"):
+            content = _convert_html_to_md(file_path)
         elif file_path.lower().endswith(".md"):
             with open(file_path, "r", encoding="utf-8") as f:
                 content = f.read()
             content = remove_yaml_front_matter(content)
 
-        # 调整内容中的标题层级
-        lines = content.split('\n')
-        adjusted_lines = []
-        for line in lines:
-            # 检查行是否是标题
-            if line.strip().startswith('#'):
-                current_level = len(line) - len(line.lstrip('#'))
-                new_level = base_level + current_level
-                new_level = min(new_level, 6)
-                adjusted_line = '#' * new_level + line[current_level:]
-                adjusted_lines.append(adjusted_line)
-            else:
-                adjusted_lines.append(line)
-
-        file_handler.write('\n'.join(adjusted_lines))
+        # 调整内容中的标题层级（单次正则替换，避免逐行 Python 循环）
+        content = _HEADING_RE.sub(
+            lambda m: '#' * min(6, base_level + len(m.group(1))), content)
+
+        # 章节内容入库时顺手做行级转换，省掉拼装后对全书的再处理
+        content = preprocess_markdown(content)
+
+        file_handler.write(content)
 
     except Exception as e:
         print(f"处理文件 {file_path} 时出错: {e}")
         file_handler.write(f"*[Error processing file: {file_path}]*\n")
 
-def generate_with_pandoc(input_md, output_file, output_format):
-    """使用 Pandoc 生成最终电子书"""
-    temp_dir = os.path.dirname(input_md)
+def generate_with_pandoc(content, output_file, output_format, temp_dir):
+    """使用 Pandoc 生成最终电子书，内容经 stdin 直接喂给 pandoc"""
     cmd = [
         "pandoc",
-        input_md,
         "-o",
         output_file,
         "--toc",
         "--standalone",
         "--no-highlight",
-        "--resource-path=" + os.path.dirname(input_md),
+        "--resource-path=" + temp_dir,
         "--resource-path=" + os.path.join(temp_dir,"images"),
     ]
 
@@ -326,22 +408,22 @@ def generate_with_pandoc(input_md, output_file, output_format):
         cmd.extend([
             "-f", "markdown+smart"
         ])
-        cover_image = os.path.join(os.path.dirname(input_md), "assets", "cover.jpg")
+        cover_image = os.path.join(temp_dir, "assets", "cover.jpg")
         if os.path.exists(cover_image):
             cmd.extend(["--epub-cover-image=" + cover_image])
 
     try:
         result = subprocess.run(
                 cmd,
+                input=content.encode('utf-8'),
                 check=True,
                 capture_output=True,
-                text=True,
             )
         if result.returncode == 0:
             print(f"已经生成电子书: {output_file}")
     except subprocess.CalledProcessError as e:
         print(f"生成电子书失败: {e}")
-        print(f"错误输出: {e.stderr}")
+        print(f"错误输出: {e.stderr.decode('utf-8', 'replace')}")
 
 def generate_ebook(root_dir, output_format="epub", output_name=None, output_dir=None):
     temp_dir = os.path.join(root_dir, "_booktemp")
@@ -352,27 +434,23 @@ def generate_ebook(root_dir, output_format="epub", output_name=None, output_dir=
     os.makedirs(images_dir, exist_ok=True)
 
     metadata = generate_metadata(root_dir)
-    main_md = os.path.join(temp_dir, "main.md")
 
-    with open(main_md, "w", encoding="utf-8") as f:
-        f.write(
-            "---\n"
-            f"title: {metadata['title']}\n"
-            f"author: {metadata['author']}\n"
-            f"date: {metadata['date']}\n"
-            "lang: zh-CN\n"
-            "---\n"
-        )
-
-        process_directory(root_dir, f, root_dir, 0)
+    # 在内存中拼装全书内容，避免反复读写 main.md
+    buf = io.StringIO()
+    buf.write(
+        "---\n"
+        f"title: {metadata['title']}\n"
+        f"author: {metadata['author']}\n"
+        f"date: {metadata['date']}\n"
+        "lang: zh-CN\n"
+        "---\n"
+    )
+    process_directory(root_dir, buf, root_dir, 0)
+    content = buf.getvalue()
 
     # 处理Markdown中的在线图片
-    process_image_urls_in_md(main_md, images_dir)
-    with open(main_md, 'r', encoding='utf-8') as f:
-            content = f.read()
-    content = preprocess_markdown(content)
-    with open(main_md, 'w', encoding='utf-8') as f:
-            f.write(content)
+    # （escape/加反斜杠/链接缩短已在 include_content 中逐章完成）
+    content, _ = process_image_urls_in_text(content, images_dir)
 
     if output_dir:
         os.makedirs(output_dir, exist_ok=True)
@@ -380,37 +458,62 @@ def generate_ebook(root_dir, output_format="epub", output_name=None, output_dir=
     else:
         output_file = os.path.join(root_dir, f"{output_name or metadata['title'] or 'book'}.{output_format}")
 
-    generate_with_pandoc(main_md, output_file, output_format)
+    generate_with_pandoc(content, output_file, output_format, temp_dir)
     return True
 
+def _check_pillow_simd():
+    """检查 Pillow 是否链接了 libjpeg-turbo（Pillow-SIMD 的 SIMD 编解码路径）"""
+    try:
+        from PIL import features
+        if not features.check_feature('libjpeg_turbo'):
+            logging.info(
+                "Pillow 未链接 libjpeg-turbo，JPEG 编解码走标量路径；"
+                "安装 Pillow-SIMD + libjpeg-turbo 可显著加速图片处理")
+    except Exception:
+        pass
+
 def main():
     CONFIG = load_config()
+    _check_pillow_simd()
     base_dir = CONFIG["paths"]["base_dir"]
     output_dir =  CONFIG["paths"]["output_dir"]
-    dirs_to_process = [
-        item for item in os.listdir(base_dir)
-        if os.path.isdir(os.path.join(base_dir, item))
-        and not item.startswith(("_", "."))
-    ]
+    with os.scandir(base_dir) as it:
+        dirs_to_process = [
+            entry.name for entry in it
+            if entry.is_dir() and not entry.name.startswith(("_", "."))
+        ]
 
     successful = 0
     failed = 0
     failed_dirs = []
 
-    for item in dirs_to_process:
-        full_path = os.path.join(base_dir, item)
+    # 每本书相互独立，按书并行（pandoc/PIL 都是 CPU 大头）
+    # 用半数核心：每本书内部还有 pandoc 的 I/O 和 PIL 工作进程要跑
+    max_workers = max(1, (os.cpu_count() or 2) // 2)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                generate_ebook,
+                os.path.join(base_dir, item),
+                "epub",
+                output_name=item,
+                output_dir=output_dir,
+            ): item
+            for item in dirs_to_process
+        }
 
-        try:
-            if generate_ebook(full_path, "epub", output_name=item,output_dir=output_dir):
-                successful += 1
-            else:
+        for future in concurrent.futures.as_completed(futures):
+            item = futures[future]
+            try:
+                if future.result():
+                    successful += 1
+                else:
+                    failed += 1
+                    failed_dirs.append(item)
+            except Exception as exc:
                 failed += 1
-
-        except Exception as exc:
-            failed += 1
-            failed_dirs.append(item)
-            print(f"处理 {item} 时出现错误: {exc}")
-            continue
+                failed_dirs.append(item)
+                print(f"处理 {item} 时出现错误: {exc}")
 
     print(f"\n完成! 成功: {successful}, 失败: {failed}")
     # 打印出生成失败的目录